@@ -1,23 +1,45 @@
 # chunking_service.py
 import re
+import string
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
 import tiktoken
-from typing import List, Dict, Optional
+from functools import lru_cache
+from typing import Iterable, List, Dict, Optional
 from dataclasses import dataclass
 from app.file_processor import ContentChunk, DocumentMetadata
 
-@dataclass
+@dataclass(slots=True)
 class EnhancedChunk:
     """Enhanced chunk with better metadata and indexing"""
     text: str
-    metadata: Dict[str, any]
+    metadata: Dict[str, any]  # Chunk-level fields only; document fields live on `doc`
     token_count: int
     chunk_id: str
     parent_doc_id: str
+    doc: DocumentMetadata  # Shared by every chunk of the same document
     page_number: Optional[int] = None
     section_title: Optional[str] = None
     chunk_index: int = 0
     overlap_with_previous: bool = False
 
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+
+class _DocIdTable(dict):
+    """str.translate table that keeps [a-zA-Z0-9_-] and maps any other character to '_'"""
+    def __missing__(self, codepoint: int) -> str:
+        self[codepoint] = '_'
+        return '_'
+
+_DOCID_TABLE = _DocIdTable(
+    (ord(c), ord(c)) for c in string.ascii_letters + string.digits + '_-'
+)
+
+@lru_cache(maxsize=4)
+def _get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Load a tiktoken encoding once per process; Encoding objects are thread-safe to share"""
+    return tiktoken.encoding_for_model(model_name)
+
 class ChunkingService:
     """Advanced chunking service with metadata preservation"""
     
@@ -27,14 +49,21 @@ class ChunkingService:
                  model_name: str = "text-embedding-3-small"):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")  # Use compatible encoding
+        self.encoding = _get_encoding("gpt-3.5-turbo")  # Use compatible encoding
         
     def count_tokens(self, text: str) -> int:
         """Count tokens in text using tiktoken"""
-        return len(self.encoding.encode(text))
+        return len(self.encoding.encode_ordinary(text))
+    
+    def _token_count_if_fits(self, text: str) -> Optional[int]:
+        """Return the token count of text if it fits in a single chunk, otherwise None"""
+        # Always an exact count: a length-based estimate can misroute text that fits to the splitter,
+        # which adds section prefixes and flattens paragraph breaks
+        token_count = self.count_tokens(text)
+        return token_count if token_count <= self.chunk_size else None
     
     def create_chunks_from_content(self, 
-                                   content_chunks: List[ContentChunk], 
+                                   content_chunks: Iterable[ContentChunk], 
                                    metadata: DocumentMetadata) -> List[EnhancedChunk]:
         """Create enhanced chunks from extracted content"""
         enhanced_chunks = []
@@ -43,16 +72,17 @@ class ChunkingService:
         
         for content_chunk in content_chunks:
             # Check if content needs to be split further
-            token_count = self.count_tokens(content_chunk.text)
+            token_count = self._token_count_if_fits(content_chunk.text)
             
-            if token_count <= self.chunk_size:
+            if token_count is not None:
                 # Content fits in one chunk
                 chunk = self._create_enhanced_chunk(
                     text=content_chunk.text,
                     content_chunk=content_chunk,
                     doc_id=doc_id,
                     chunk_index=global_chunk_index,
-                    metadata=metadata
+                    metadata=metadata,
+                    token_count=token_count
                 )
                 enhanced_chunks.append(chunk)
                 global_chunk_index += 1
@@ -68,53 +98,46 @@ class ChunkingService:
                              content_chunk: ContentChunk, 
                              doc_id: str, 
                              start_index: int,
-                             metadata: DocumentMetadata) -> List[EnhancedChunk]:
-        """Split large content into smaller chunks with overlap"""
+                             metadata: DocumentMetadata,
+                             prefix: str = "") -> List[EnhancedChunk]:
+        """Split large content into smaller chunks with overlap, starting each chunk with prefix"""
         chunks = []
         text = content_chunk.text
+        # Reserve room for the prefix so it is counted once rather than re-tokenized per chunk
+        prefix_tokens = self.count_tokens(prefix) if prefix else 0
+        chunk_budget = self.chunk_size - prefix_tokens
         
         # Try to split on natural boundaries first
         sentences = self._split_into_sentences(text)
         
-        current_chunk = ""
-        current_sentences = []
-        chunk_index = start_index
+        # Tokenize each sentence exactly once; cum[i] is the token count of sentences[:i]
+        lengths = [len(ids) for ids in self.encoding.encode_ordinary_batch(sentences)]
+        cum = [0, *accumulate(lengths)]
         
-        for sentence in sentences:
-            test_chunk = current_chunk + " " + sentence if current_chunk else sentence
-            
-            if self.count_tokens(test_chunk) <= self.chunk_size:
-                current_chunk = test_chunk
-                current_sentences.append(sentence)
-            else:
-                # Current chunk is full, save it
-                if current_chunk:
-                    chunk = self._create_enhanced_chunk(
-                        text=current_chunk.strip(),
-                        content_chunk=content_chunk,
-                        doc_id=doc_id,
-                        chunk_index=chunk_index,
-                        metadata=metadata
-                    )
-                    chunks.append(chunk)
-                    chunk_index += 1
-                
-                # Start new chunk with overlap
-                overlap_sentences = self._get_overlap_sentences(current_sentences)
-                current_chunk = " ".join(overlap_sentences + [sentence])
-                current_sentences = overlap_sentences + [sentence]
+        chunk_index = start_index
+        start = 0
+        end = 0
+        previous_end = 0
         
-        # Add final chunk if there's remaining content
-        if current_chunk.strip():
+        while end < len(sentences):
+            # Extend to the furthest sentence that fits the budget, always taking at least one new sentence
+            end = max(bisect_right(cum, cum[start] + chunk_budget, start) - 1, end + 1)
             chunk = self._create_enhanced_chunk(
-                text=current_chunk.strip(),
+                # Sentences are already stripped, so the join needs no strip or recount
+                text=prefix + " ".join(sentences[start:end]),
                 content_chunk=content_chunk,
                 doc_id=doc_id,
                 chunk_index=chunk_index,
                 metadata=metadata,
-                has_overlap=chunk_index > start_index
+                has_overlap=start < previous_end,
+                token_count=prefix_tokens + cum[end] - cum[start]
             )
             chunks.append(chunk)
+            chunk_index += 1
+            
+            # Start next chunk with overlap
+            previous_end = end
+            start = self._get_overlap_start(cum, start, end)
         
         return chunks
     
@@ -124,20 +147,17 @@ class ChunkingService:
                                doc_id: str,
                                chunk_index: int,
                                metadata: DocumentMetadata,
-                               has_overlap: bool = False) -> EnhancedChunk:
+                               has_overlap: bool = False,
+                               token_count: Optional[int] = None) -> EnhancedChunk:
         """Create an enhanced chunk with comprehensive metadata"""
         
         chunk_id = f"{doc_id}_chunk_{chunk_index}"
-        token_count = self.count_tokens(text)
+        if token_count is None:
+            token_count = self.count_tokens(text)
         
-        # Combine metadata from content chunk and document
+        # Document-level metadata is shared through `doc` rather than copied into every chunk
         enhanced_metadata = {
             **content_chunk.metadata,
-            'doc_title': metadata.title,
-            'doc_author': metadata.author,
-            'doc_created_date': metadata.created_date.isoformat() if metadata.created_date else None,
-            'doc_file_size': metadata.file_size,
-            'total_pages': metadata.pages,
             'chunk_token_count': token_count,
             'chunk_character_count': len(text),
             'has_overlap': has_overlap
@@ -149,6 +169,7 @@ class ChunkingService:
             token_count=token_count,
             chunk_id=chunk_id,
             parent_doc_id=doc_id,
+            doc=metadata,
             page_number=content_chunk.page_number,
             section_title=content_chunk.section_title,
             chunk_index=chunk_index,
@@ -158,39 +179,23 @@ class ChunkingService:
     def _split_into_sentences(self, text: str) -> List[str]:
         """Split text into sentences using regex"""
         # Simple sentence splitting - can be enhanced with NLTK
-        sentence_pattern = r'(?<=[.!?])\s+'
-        sentences = re.split(sentence_pattern, text)
+        sentences = _SENTENCE_RE.split(text)
         return [s.strip() for s in sentences if s.strip()]
     
-    def _get_overlap_sentences(self, sentences: List[str]) -> List[str]:
-        """Get sentences for overlap with previous chunk"""
-        if not sentences:
-            return []
-        
-        # Calculate how many sentences to include for overlap
-        overlap_text = ""
-        overlap_sentences = []
-        
-        # Work backwards from end of sentences
-        for sentence in reversed(sentences):
-            test_overlap = sentence + " " + overlap_text if overlap_text else sentence
-            if self.count_tokens(test_overlap) <= self.chunk_overlap:
-                overlap_text = test_overlap
-                overlap_sentences.insert(0, sentence)
-            else:
-                break
-        
-        return overlap_sentences
+    def _get_overlap_start(self, cum: List[int], start: int, end: int) -> int:
+        """Get the index of the first sentence of sentences[start:end] to repeat as overlap"""
+        # Earliest k whose suffix sentences[k:end] still fits within chunk_overlap tokens
+        return bisect_left(cum, cum[end] - self.chunk_overlap, start, end)
     
     def _generate_doc_id(self, filename: str) -> str:
         """Generate a document ID from filename"""
         # Remove extension and special characters
-        doc_id = re.sub(r'[^a-zA-Z0-9_-]', '_', filename.lower())
-        doc_id = re.sub(r'_+', '_', doc_id).strip('_')
-        return doc_id
+        doc_id = filename.lower().translate(_DOCID_TABLE)
+        # Collapse runs of underscores and trim them from both ends
+        return '_'.join(filter(None, doc_id.split('_')))
     
     def create_smart_chunks(self, 
-                            content_chunks: List[ContentChunk], 
+                            content_chunks: Iterable[ContentChunk], 
                             metadata: DocumentMetadata,
                             preserve_structure: bool = True) -> List[EnhancedChunk]:
         """Create chunks with smart structure preservation"""
@@ -211,13 +216,15 @@ class ChunkingService:
                 global_chunk_index += len(section_chunks)
             else:
                 # Regular chunking for unstructured content
-                if self.count_tokens(content_chunk.text) <= self.chunk_size:
+                token_count = self._token_count_if_fits(content_chunk.text)
+                if token_count is not None:
                     chunk = self._create_enhanced_chunk(
                         text=content_chunk.text,
                         content_chunk=content_chunk,
                         doc_id=doc_id,
                         chunk_index=global_chunk_index,
-                        metadata=metadata
+                        metadata=metadata,
+                        token_count=token_count
                     )
                     enhanced_chunks.append(chunk)
                     global_chunk_index += 1
@@ -237,31 +244,21 @@ class ChunkingService:
         text = content_chunk.text
         
         # If section fits in one chunk, keep it together
-        if self.count_tokens(text) <= self.chunk_size:
+        token_count = self._token_count_if_fits(text)
+        if token_count is not None:
             chunk = self._create_enhanced_chunk(
                 text=text,
                 content_chunk=content_chunk,
                 doc_id=doc_id,
                 chunk_index=start_index,
-                metadata=metadata
+                metadata=metadata,
+                token_count=token_count
             )
             return [chunk]
         
         # Section is too large, split it but preserve context
         # Add section title to each chunk for context
         section_title = content_chunk.section_title or ""
-        if section_title:
-            text_with_context = f"Section: {section_title}\n\n{text}"
-        else:
-            text_with_context = text
-        
-        # Create a temporary content chunk with context
-        temp_content_chunk = ContentChunk(
-            text=text_with_context,
-            metadata=content_chunk.metadata,
-            page_number=content_chunk.page_number,
-            section_title=content_chunk.section_title,
-            chunk_index=content_chunk.chunk_index
-        )
+        prefix = f"Section: {section_title}\n\n" if section_title else ""
         
-        return self._split_large_content(temp_content_chunk, doc_id, start_index, metadata)
+        return self._split_large_content(content_chunk, doc_id, start_index, metadata, prefix=prefix)
\ No newline at end of file
@@ -1,6 +1,8 @@
 # embeddings.py
 import os
+import asyncio
 import httpx
+import orjson
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -32,38 +34,166 @@ else:
     raise ValueError("OPENAI_API_KEY environment variable is not set. Please check your environment configuration.")
 
 EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 256  # Texts per request, well below the API's per-request input cap
+EMBEDDING_CONCURRENCY = 8  # Sub-batch requests in flight per embed_text call
 
-async def embed_text(texts: list[str]) -> list[list[float]]:
-    if not OPENAI_API_KEY:
-        raise ValueError("OpenAI API key is not configured. This might be due to an environment configuration issue.")
-    
+print(f"Embedding requests will use model: {EMBEDDING_MODEL}")
+
+# One pooled HTTP/2 client shared by all requests so they reuse warm connections
+_client: httpx.AsyncClient | None = None
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared client, opening a new one if none is open (e.g. after aclose on shutdown)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            headers={
+                "Authorization": f"Bearer {OPENAI_API_KEY.strip()}",  # Strip any whitespace
+                "Content-Type": "application/json"
+            }
+        )
+    return _client
+
+async def _request_embeddings(texts: list[str]) -> list[list[float]]:
+    """Embed a single sub-batch of texts with one API request"""
     try:
-        async with httpx.AsyncClient() as client:
-            print(f"Making request to OpenAI API with model: {EMBEDDING_MODEL}")
-            # Log headers safely (excluding the actual key)
-            auth_header = f"Bearer {OPENAI_API_KEY[:7]}..." if len(OPENAI_API_KEY) > 7 else "Bearer [hidden]"
-            print(f"Using Authorization header format: {auth_header}")
+        resp = await _get_client().post(
+            "https://api.openai.com/v1/embeddings",
+            json={"model": EMBEDDING_MODEL, "input": texts}
+        )
+        
+        if resp.status_code == 401:
+            error_msg = resp.text
+            print(f"Authentication failed. Error details: {error_msg}")
+            print("Please verify:\n1. API key format (should start with 'sk-')\n2. No whitespace in key\n3. Key is not expired")
+            raise ValueError(f"OpenAI API authentication failed: {error_msg}")
             
-            resp = await client.post(
-                "https://api.openai.com/v1/embeddings",
-                headers={
-                    "Authorization": f"Bearer {OPENAI_API_KEY.strip()}",  # Strip any whitespace
-                    "Content-Type": "application/json"
-                },
-                json={"model": EMBEDDING_MODEL, "input": texts}
-            )
-            
-            if resp.status_code == 401:
-                error_msg = await resp.text()
-                print(f"Authentication failed. Error details: {error_msg}")
-                print("Please verify:\n1. API key format (should start with 'sk-')\n2. No whitespace in key\n3. Key is not expired")
-                raise ValueError(f"OpenAI API authentication failed: {error_msg}")
-                
-            resp.raise_for_status()
-            return resp.json()["data"]
+        resp.raise_for_status()
+        data = sorted(orjson.loads(resp.content)["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in data]
     except httpx.HTTPStatusError as e:
         print(f"HTTP error occurred: {e.response.status_code} - {e.response.text}")
         raise
     except Exception as e:
         print(f"An error occurred while calling OpenAI API: {str(e)}")
         raise
+
+async def embed_text(texts: list[str]) -> list[list[float]]:
+    """Embed texts in sub-batches sent concurrently, returning vectors in input order"""
+    if not OPENAI_API_KEY:
+        raise ValueError("OpenAI API key is not configured. This might be due to an environment configuration issue.")
+    
+    # Embed each distinct text once and fan the vectors back out to every position
+    unique_index: dict[str, int] = {}
+    unique_texts: list[str] = []
+    positions: list[int] = []
+    for text in texts:
+        index = unique_index.get(text)
+        if index is None:
+            index = unique_index[text] = len(unique_texts)
+            unique_texts.append(text)
+        positions.append(index)
+    
+    semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+    
+    async def embed_batch(batch: list[str]) -> list[list[float]]:
+        async with semaphore:
+            return await _request_embeddings(batch)
+    
+    batches = [unique_texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(unique_texts), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    embeddings = [embedding for batch_embeddings in results for embedding in batch_embeddings]
+    return [embeddings[index] for index in positions]
+
+class BatchingEmbedder:
+    """Coalesces concurrent single-text embedding calls into shared API requests"""
+    
+    def __init__(self, max_batch: int = 64, max_wait: float = 0.05):
+        self.max_batch = max_batch
+        self.max_wait = max_wait  # Seconds to wait for more texts after the first arrives
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._dispatches: set[asyncio.Task] = set()  # Strong references so in-flight batches are not garbage-collected
+    
+    async def embed(self, text: str) -> list[float]:
+        """Embed one text, sharing the request with any others queued in the same window"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._collect())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+    
+    async def aclose(self) -> None:
+        """Stop collecting, cancel in-flight requests and fail every caller still waiting"""
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        for task in self._dispatches:
+            task.cancel()
+        await asyncio.gather(self._worker, *self._dispatches, return_exceptions=True)
+        self._worker = None
+        
+        # Texts queued but never collected into a batch
+        queued = []
+        while not self._queue.empty():
+            queued.append(self._queue.get_nowait())
+        self._fail(queued, RuntimeError("Embedding batcher is closed"))
+    
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Send without blocking collection of the next batch
+                task = asyncio.create_task(self._dispatch(batch))
+                self._dispatches.add(task)
+                task.add_done_callback(self._dispatches.discard)
+                batch = []
+        except asyncio.CancelledError:
+            self._fail(batch, RuntimeError("Embedding batcher is closed"))
+            raise
+    
+    async def _dispatch(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        try:
+            embeddings = await embed_text([text for text, _ in batch])
+        except asyncio.CancelledError:
+            self._fail(batch, RuntimeError("Embedding batcher is closed"))
+            raise
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+    
+    @staticmethod
+    def _fail(batch: list[tuple[str, asyncio.Future]], error: BaseException) -> None:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+# Shared by query paths so concurrent user queries are embedded together
+query_embedder = BatchingEmbedder()
+
+async def aclose() -> None:
+    """Stop the query batcher and close the shared HTTP client; call on application shutdown"""
+    global _client
+    await query_embedder.aclose()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -1,11 +1,17 @@
 # file_processor.py
 import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
 from dataclasses import dataclass
 from datetime import datetime
 import re
 
+if TYPE_CHECKING:
+    from app.chunking_service import ChunkingService  # chunking_service imports this module
+
 # Optional imports for various document processors
 try:
     import fitz  # PyMuPDF
@@ -15,11 +21,11 @@ except ImportError:
     fitz = None
 
 try:
-    from docx import Document
+    from lxml import etree  # Parses DOCX XML parts directly
     DOCX_AVAILABLE = True
 except ImportError:
     DOCX_AVAILABLE = False
-    Document = None
+    etree = None
 
 try:
     import magic
@@ -28,7 +34,23 @@ except ImportError:
     MAGIC_AVAILABLE = False
     magic = None
 
-@dataclass
+_MD_HEADER_RE = re.compile(rb'(?m)^(#{1,6})[ \t]+(.+)$')
+
+# WordprocessingML and OPC core-properties element names used by the DOCX parser
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_BODY, _W_P, _W_R, _W_T = f'{_W_NS}body', f'{_W_NS}p', f'{_W_NS}r', f'{_W_NS}t'
+_W_TAB, _W_BR, _W_CR = f'{_W_NS}tab', f'{_W_NS}br', f'{_W_NS}cr'
+_W_PTAB, _W_NOBREAKHYPHEN = f'{_W_NS}ptab', f'{_W_NS}noBreakHyphen'
+_W_PSTYLE = f'{_W_NS}pPr/{_W_NS}pStyle'
+_W_STYLE, _W_NAME = f'{_W_NS}style', f'{_W_NS}name'
+_W_VAL, _W_TYPE, _W_STYLE_ID, _W_DEFAULT = f'{_W_NS}val', f'{_W_NS}type', f'{_W_NS}styleId', f'{_W_NS}default'
+_DC_NS = '{http://purl.org/dc/elements/1.1/}'
+_DCTERMS_NS = '{http://purl.org/dc/terms/}'
+
+# Uploaded XML is untrusted: never expand entities (lxml < 5 did by default) or fetch over the network
+_XML_PARSER_OPTIONS = {'resolve_entities': False, 'no_network': True}
+
+@dataclass(slots=True, frozen=True)
 class DocumentMetadata:
     """Metadata extracted from documents"""
     filename: str
@@ -43,7 +65,7 @@ class DocumentMetadata:
     modified_date: Optional[datetime] = None
     language: str = ""
 
-@dataclass
+@dataclass(slots=True)
 class ContentChunk:
     """A chunk of content with associated metadata"""
     text: str
@@ -64,7 +86,19 @@ class FileProcessor:
     }
     
     def __init__(self):
-        self.mime = magic.Magic(mime=True) if MAGIC_AVAILABLE else None
+        self._mime = None  # Created on first use so instances stay picklable
+    
+    @property
+    def mime(self):
+        """Lazily created python-magic handle, one per process"""
+        if self._mime is None and MAGIC_AVAILABLE:
+            self._mime = magic.Magic(mime=True)
+        return self._mime
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mime'] = None
+        return state
     
     def detect_file_type(self, file_path: str) -> str:
         """Detect file type using python-magic or fallback to file extension"""
@@ -86,87 +120,109 @@ class FileProcessor:
         }
         return extension_map.get(ext, 'unknown')
     
-    def extract_pdf_content(self, file_path: str) -> Tuple[List[ContentChunk], DocumentMetadata]:
-        """Extract content and metadata from PDF files"""
+    def extract_pdf_content(self, file_path: str) -> Tuple[Iterator[ContentChunk], DocumentMetadata]:
+        """Extract metadata from PDF files and stream their content page by page"""
         if not PYMUPDF_AVAILABLE:
             raise ValueError("PyMuPDF (fitz) is not available. Install with: pip install PyMuPDF")
         
         doc = fitz.open(file_path)
-        chunks = []
-        
-        # Extract metadata
-        metadata = DocumentMetadata(
-            filename=Path(file_path).name,
-            file_type='pdf',
-            file_size=os.path.getsize(file_path),
-            pages=len(doc),
-            author=doc.metadata.get('author', ''),
-            title=doc.metadata.get('title', ''),
-            subject=doc.metadata.get('subject', ''),
-            creator=doc.metadata.get('creator', ''),
-            created_date=self._parse_pdf_date(doc.metadata.get('creationDate')),
-            modified_date=self._parse_pdf_date(doc.metadata.get('modDate'))
-        )
         
-        # Extract text content page by page
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            text = page.get_text()
-            
-            if text.strip():  # Only add non-empty pages
-                chunk = ContentChunk(
-                    text=text.strip(),
-                    metadata={
-                        'source_file': metadata.filename,
-                        'file_type': 'pdf',
-                        'page_number': page_num + 1,
-                        'total_pages': len(doc)
-                    },
-                    page_number=page_num + 1
-                )
-                chunks.append(chunk)
+        try:
+            # Extract metadata
+            metadata = DocumentMetadata(
+                filename=Path(file_path).name,
+                file_type='pdf',
+                file_size=os.path.getsize(file_path),
+                pages=len(doc),
+                author=doc.metadata.get('author', ''),
+                title=doc.metadata.get('title', ''),
+                subject=doc.metadata.get('subject', ''),
+                creator=doc.metadata.get('creator', ''),
+                created_date=self._parse_pdf_date(doc.metadata.get('creationDate')),
+                modified_date=self._parse_pdf_date(doc.metadata.get('modDate'))
+            )
+        except Exception:
+            doc.close()
+            raise
         
-        doc.close()
-        return chunks, metadata
+        return self._iter_pdf_pages(doc, metadata), metadata
+    
+    def _iter_pdf_pages(self, doc, metadata: DocumentMetadata) -> Iterator[ContentChunk]:
+        """Yield a chunk per non-empty page, keeping only one page in memory at a time"""
+        try:
+            for page_num in range(metadata.pages):
+                page = doc.load_page(page_num)
+                text = page.get_text("text")
+                page = None  # Let MuPDF release the page before the next one is loaded
+                
+                if text and not text.isspace():  # Only add non-empty pages
+                    yield ContentChunk(
+                        text=text.strip(),
+                        metadata={
+                            'source_file': metadata.filename,
+                            'file_type': 'pdf',
+                            'page_number': page_num + 1
+                        },
+                        page_number=page_num + 1
+                    )
+        finally:
+            doc.close()
     
     def extract_docx_content(self, file_path: str) -> Tuple[List[ContentChunk], DocumentMetadata]:
         """Extract content and metadata from DOCX files"""
         if not DOCX_AVAILABLE:
-            raise ValueError("python-docx is not available. Install with: pip install python-docx")
+            raise ValueError("lxml is not available. Install with: pip install lxml")
         
-        doc = Document(file_path)
         chunks = []
         
-        # Extract metadata
-        core_props = doc.core_properties
-        metadata = DocumentMetadata(
-            filename=Path(file_path).name,
-            file_type='docx',
-            file_size=os.path.getsize(file_path),
-            pages=0,  # DOCX doesn't have fixed pages
-            author=core_props.author or '',
-            title=core_props.title or '',
-            subject=core_props.subject or '',
-            creator=core_props.author or '',
-            created_date=core_props.created,
-            modified_date=core_props.modified,
-            language=core_props.language or ''
-        )
-        
-        # Extract text content
-        full_text = []
-        current_section = None
-        
-        for para in doc.paragraphs:
-            text = para.text.strip()
-            if not text:
-                continue
-                
-            # Detect headings (simple heuristic based on style or formatting)
-            if self._is_heading(para):
-                current_section = text
+        with zipfile.ZipFile(file_path) as archive:
+            # Extract metadata
+            core_props = self._read_docx_core_properties(archive)
+            metadata = DocumentMetadata(
+                filename=Path(file_path).name,
+                file_type='docx',
+                file_size=os.path.getsize(file_path),
+                pages=0,  # DOCX doesn't have fixed pages
+                author=core_props.get('creator', ''),
+                title=core_props.get('title', ''),
+                subject=core_props.get('subject', ''),
+                creator=core_props.get('creator', ''),
+                created_date=self._parse_docx_date(core_props.get('created')),
+                modified_date=self._parse_docx_date(core_props.get('modified')),
+                language=core_props.get('language', '')
+            )
+            
+            # Headings are detected by style name; paragraphs only reference style ids
+            style_names, default_style_name = self._read_docx_style_names(archive)
             
-            full_text.append(text)
+            # Extract text content in a single streaming pass over the body XML
+            full_text = []
+            current_section = None
+            
+            with archive.open('word/document.xml') as document_xml:
+                for _, para in etree.iterparse(document_xml, tag=_W_P, **_XML_PARSER_OPTIONS):
+                    # Only top-level body paragraphs; table cells and text boxes are skipped
+                    if para.getparent().tag != _W_BODY:
+                        continue
+                    
+                    text = self._docx_paragraph_text(para).strip()
+                    style = para.find(_W_PSTYLE)
+                    style_id = style.get(_W_VAL) if style is not None else None
+                    style_name = style_names.get(style_id, default_style_name)
+                    
+                    # Release parsed paragraphs (and tables before them) as we go
+                    para.clear()
+                    while para.getprevious() is not None:
+                        del para.getparent()[0]
+                    
+                    if not text:
+                        continue
+                    
+                    # Detect headings (simple heuristic based on style or formatting)
+                    if self._is_heading(text, style_name):
+                        current_section = text
+                    
+                    full_text.append(text)
         
         # Create chunks from paragraphs or sections
         if full_text:
@@ -184,11 +240,60 @@ class FileProcessor:
         
         return chunks, metadata
     
+    def _read_docx_core_properties(self, archive: zipfile.ZipFile) -> Dict[str, str]:
+        """Read title, creator and other core properties from docProps/core.xml"""
+        try:
+            root = etree.fromstring(archive.read('docProps/core.xml'), etree.XMLParser(**_XML_PARSER_OPTIONS))
+        except KeyError:
+            return {}
+        
+        props = {}
+        for ns, names in ((_DC_NS, ('title', 'subject', 'creator', 'language')),
+                          (_DCTERMS_NS, ('created', 'modified'))):
+            for name in names:
+                value = root.findtext(f'{ns}{name}')
+                if value:
+                    props[name] = value.strip()
+        return props
+    
+    def _read_docx_style_names(self, archive: zipfile.ZipFile) -> Tuple[Dict[str, str], str]:
+        """Map paragraph style ids to style names, plus the default paragraph style's name"""
+        try:
+            root = etree.fromstring(archive.read('word/styles.xml'), etree.XMLParser(**_XML_PARSER_OPTIONS))
+        except KeyError:
+            return {}, ''
+        
+        # Ids can be localized (German Word writes 'berschrift1' for 'heading 1'); names are not
+        names = {}
+        default_name = ''
+        for style in root.iter(_W_STYLE):
+            if style.get(_W_TYPE) != 'paragraph':
+                continue
+            name = style.find(_W_NAME)
+            name = name.get(_W_VAL, '') if name is not None else ''
+            names[style.get(_W_STYLE_ID)] = name
+            if style.get(_W_DEFAULT) in ('1', 'true'):
+                default_name = name
+        return names, default_name
+    
+    def _docx_paragraph_text(self, paragraph) -> str:
+        """Concatenate the run text of a <w:p>, rendering tabs, hyphens and line breaks like python-docx"""
+        parts = []
+        for el in paragraph.iter(_W_T, _W_TAB, _W_PTAB, _W_BR, _W_CR, _W_NOBREAKHYPHEN):
+            if el.getparent().tag != _W_R:
+                continue  # Skip tab stop definitions and other non-run elements
+            if el.tag == _W_T:
+                parts.append(el.text or '')
+            elif el.tag in (_W_TAB, _W_PTAB):
+                parts.append('\t')
+            elif el.tag == _W_NOBREAKHYPHEN:
+                parts.append('-')
+            elif el.tag == _W_CR or el.get(_W_TYPE, 'textWrapping') == 'textWrapping':
+                parts.append('\n')  # Page and column breaks carry no text
+        return ''.join(parts)
+    
     def extract_markdown_content(self, file_path: str) -> Tuple[List[ContentChunk], DocumentMetadata]:
         """Extract content and metadata from Markdown files"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
         # Extract metadata
         metadata = DocumentMetadata(
             filename=Path(file_path).name,
@@ -197,8 +302,8 @@ class FileProcessor:
             pages=0
         )
         
-        # Parse markdown structure
-        chunks = self._parse_markdown_sections(content, metadata.filename)
+        # Parse markdown structure from the raw bytes
+        chunks = self._parse_markdown_sections(Path(file_path).read_bytes(), metadata.filename)
         
         return chunks, metadata
     
@@ -224,7 +329,7 @@ class FileProcessor:
         
         return [chunk], metadata
     
-    def process_file(self, file_path: str) -> Tuple[List[ContentChunk], DocumentMetadata]:
+    def process_file(self, file_path: str) -> Tuple[Iterable[ContentChunk], DocumentMetadata]:
         """Main method to process any supported file type"""
         file_type = self.detect_file_type(file_path)
         
@@ -234,7 +339,7 @@ class FileProcessor:
             return self.extract_pdf_content(file_path)
         elif file_type == 'docx':
             if not DOCX_AVAILABLE:
-                raise ValueError("DOCX processing requires python-docx. Install with: pip install python-docx")
+                raise ValueError("DOCX processing requires lxml. Install with: pip install lxml")
             return self.extract_docx_content(file_path)
         elif file_type == 'markdown':
             return self.extract_markdown_content(file_path)
@@ -245,6 +350,33 @@ class FileProcessor:
                            (", pdf" if PYMUPDF_AVAILABLE else "") + 
                            (", docx" if DOCX_AVAILABLE else ""))
     
+    def process_and_chunk(self, file_path: str, chunking_service: "ChunkingService") -> Tuple[list, DocumentMetadata]:
+        """Process a file and chunk it in one call"""
+        # Extraction can be lazy (PDF pages), so chunking must consume it while the file is open
+        content_chunks, metadata = self.process_file(file_path)
+        enhanced_chunks = chunking_service.create_smart_chunks(content_chunks, metadata, preserve_structure=True)
+        return enhanced_chunks, metadata
+    
+    def process_files(self, 
+                      file_paths: List[str], 
+                      workers: Optional[int] = None,
+                      chunk_size: int = 1000,
+                      chunk_overlap: int = 200) -> List[Tuple[list, DocumentMetadata]]:
+        """Process and chunk several files in parallel across worker processes"""
+        worker = partial(_process_and_chunk, self, chunk_size, chunk_overlap)
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            return list(executor.map(worker, file_paths))
+    
+    def _parse_docx_date(self, date_str: Optional[str]) -> Optional[datetime]:
+        """Parse W3CDTF dates from DOCX core properties"""
+        if not date_str:
+            return None
+        try:
+            # Core property dates look like: YYYY-MM-DDTHH:MM:SSZ
+            return datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    
     def _parse_pdf_date(self, date_str: str) -> Optional[datetime]:
         """Parse PDF date format"""
         if not date_str:
@@ -258,14 +390,13 @@ class FileProcessor:
             pass
         return None
     
-    def _is_heading(self, paragraph) -> bool:
+    def _is_heading(self, text: str, style_name: str) -> bool:
         """Simple heuristic to detect if a paragraph is a heading"""
         # Check if paragraph uses heading style
-        if paragraph.style.name.startswith('Heading'):
+        if style_name.lower().startswith('heading'):
             return True
         
         # Check if text is short and potentially a title
-        text = paragraph.text.strip()
         if len(text) < 100 and len(text.split()) < 10:
             # Check if it's all caps or title case
             if text.isupper() or text.istitle():
@@ -273,47 +404,41 @@ class FileProcessor:
         
         return False
     
-    def _parse_markdown_sections(self, content: str, filename: str) -> List[ContentChunk]:
+    def _parse_markdown_sections(self, content: bytes, filename: str) -> List[ContentChunk]:
         """Parse markdown content into sections based on headers"""
-        chunks = []
-        lines = content.split('\n')
-        current_section = None
-        current_content = []
+        if b'\r' in content:
+            content = content.replace(b'\r\n', b'\n')  # Match text-mode newline handling
         
-        for line in lines:
-            # Check for markdown headers
-            header_match = re.match(r'^(#{1,6})\s+(.+)$', line)
-            if header_match:
-                # Save previous section if exists
-                if current_content:
-                    chunk = ContentChunk(
-                        text='\n'.join(current_content).strip(),
-                        metadata={
-                            'source_file': filename,
-                            'file_type': 'markdown',
-                            'section_title': current_section
-                        },
-                        section_title=current_section
-                    )
-                    chunks.append(chunk)
-                
-                # Start new section
-                current_section = header_match.group(2).strip()
-                current_content = [line]
-            else:
-                current_content.append(line)
+        # Locate every header in one scan, then slice sections between them by byte offset
+        boundaries = [(m.start(), m.group(2).decode('utf-8').strip()) for m in _MD_HEADER_RE.finditer(content)]
+        if not boundaries or boundaries[0][0] > 0:
+            boundaries.insert(0, (0, None))  # Content before the first header
         
-        # Add final section
-        if current_content:
+        chunks = []
+        for i, (start, section_title) in enumerate(boundaries):
+            end = boundaries[i + 1][0] if i + 1 < len(boundaries) else len(content)
+            if start == end:
+                continue  # Empty file
             chunk = ContentChunk(
-                text='\n'.join(current_content).strip(),
+                text=content[start:end].decode('utf-8').strip(),
                 metadata={
                     'source_file': filename,
                     'file_type': 'markdown',
-                    'section_title': current_section
+                    'section_title': section_title
                 },
-                section_title=current_section
+                section_title=section_title
             )
             chunks.append(chunk)
         
         return chunks
+
+def _process_and_chunk(processor: FileProcessor, 
+                       chunk_size: int, 
+                       chunk_overlap: int, 
+                       file_path: str) -> Tuple[list, DocumentMetadata]:
+    """Worker entry point; chunks inside the worker so only chunk lists are pickled back"""
+    from app.chunking_service import ChunkingService  # Imported here to avoid a circular import
+    
+    # tiktoken encodings do not pickle, so each worker builds its own service from the settings
+    chunking_service = ChunkingService(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return processor.process_and_chunk(file_path, chunking_service)
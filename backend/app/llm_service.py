@@ -1,12 +1,28 @@
-import os, httpx
+import os, httpx, orjson
+from typing import AsyncIterator
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GPT_MODEL = "gpt-4o"  # or gpt-3.5-turbo
 
-async def generate_answer(contexts: list[str], query: str) -> str:
+# One pooled HTTP/2 client for every completion request
+_client: httpx.AsyncClient | None = None
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared client, opening a new one if none is open (e.g. after aclose on shutdown)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(60.0, connect=5.0),
+            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}
+        )
+    return _client
+
+def _build_prompt(contexts: list[str], query: str) -> str:
     snippets = "\n\n".join(contexts)
-    prompt = f"""You are a helpful assistant that answers technical questions using the document context below.
+    return f"""You are a helpful assistant that answers technical questions using the document context below.
     If answer is not in context, say "I don't know." Use bullet points.
     
     Context:
@@ -17,11 +33,56 @@ async def generate_answer(contexts: list[str], query: str) -> str:
 
     Answer:"""
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
-            json={"model": GPT_MODEL, "messages": [{"role":"system", "content":prompt}]}
-        )
+def _is_retryable(exc: BaseException) -> bool:
+    """Retry on rate limiting and transient server errors"""
+    return isinstance(exc, httpx.HTTPStatusError) and (
+        exc.response.status_code == 429 or exc.response.status_code >= 500
+    )
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_exponential(min=1, max=30),
+    stop=stop_after_attempt(4),
+    reraise=True
+)
+async def _open_completion_stream(prompt: str) -> httpx.Response:
+    client = _get_client()
+    request = client.build_request(
+        "POST",
+        "https://api.openai.com/v1/chat/completions",
+        json={"model": GPT_MODEL, "messages": [{"role":"system", "content":prompt}], "stream": True}
+    )
+    resp = await client.send(request, stream=True)
+    if resp.is_error:
+        await resp.aread()  # Keep the error body available on the raised exception
+        await resp.aclose()
         resp.raise_for_status()
-        return resp.json()["choices"][0]["message"]["content"]
+    return resp
+
+async def stream_answer(contexts: list[str], query: str) -> AsyncIterator[str]:
+    """Yield answer text incrementally as the completion is streamed back"""
+    resp = await _open_completion_stream(_build_prompt(contexts, query))
+    try:
+        async for line in resp.aiter_lines():
+            # Server-sent events: payload lines are prefixed with "data:"
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            choices = orjson.loads(data).get("choices")
+            content = choices[0].get("delta", {}).get("content") if choices else None
+            if content:
+                yield content
+    finally:
+        await resp.aclose()
+
+async def generate_answer(contexts: list[str], query: str) -> str:
+    return "".join([token async for token in stream_answer(contexts, query)])
+
+async def aclose() -> None:
+    """Close the shared HTTP client; call on application shutdown"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -1,14 +1,22 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+from async_lru import alru_cache
 from app.vector_store import InMemoryStore
 from app.llm_service import generate_answer
+from app import embeddings, llm_service
 from app.file_processor import FileProcessor
 from app.chunking_service import ChunkingService
 import tempfile
+import shutil
 import os
+from contextlib import asynccontextmanager
 from typing import List, Optional
 
+UPLOAD_COPY_BUFFER_SIZE = 1 << 20
+
 class IngestRequest(BaseModel):
     documents: list[str]
 
@@ -22,7 +30,20 @@ class UploadResponse(BaseModel):
     chunks_created: int
     metadata: dict
 
-app = FastAPI(title="AI Knowledge Assistant API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Release pooled OpenAI connections on shutdown
+    await embeddings.aclose()
+    await llm_service.aclose()
+
+# orjson encodes responses (chunk texts and metadata) much faster than the stdlib json module
+app = FastAPI(
+    title="AI Knowledge Assistant API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -61,19 +82,15 @@ async def upload_file(file: UploadFile = File(...)):
                 detail=f"Unsupported file type. Allowed types: {', '.join(allowed_extensions)}"
             )
         
-        # Save uploaded file temporarily
+        # Stream the upload to a temporary file in 1 MB blocks, off the event loop
         with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file.filename}") as temp_file:
-            contents = await file.read()
-            temp_file.write(contents)
+            await run_in_threadpool(shutil.copyfileobj, file.file, temp_file, UPLOAD_COPY_BUFFER_SIZE)
             temp_file_path = temp_file.name
         
         try:
-            # Process the file
-            content_chunks, metadata = file_processor.process_file(temp_file_path)
-            
-            # Create enhanced chunks
-            enhanced_chunks = chunking_service.create_smart_chunks(
-                content_chunks, metadata, preserve_structure=True
+            # Parse and chunk in a worker thread so other requests are served meanwhile
+            enhanced_chunks, metadata = await run_in_threadpool(
+                file_processor.process_and_chunk, temp_file_path, chunking_service
             )
             
             # Extract text for vector store
@@ -108,17 +125,21 @@ async def ingest(req: IngestRequest):
     count = await store.ingest(req.documents)
     return {"ingested": count}
 
+@alru_cache(maxsize=256)
+async def _cached_query(query: str, top_k: int, version: int):
+    """Memoized store.query; keying on the store version invalidates entries on any ingest or delete"""
+    return await store.query(query, top_k)
+
 @app.post("/api/query")
 async def query(req: QueryRequest):
     """Query the knowledge base and get AI-generated answers"""
-    docs = await store.query(req.query, req.top_k)
-    snippets = [doc for doc, _ in docs]
+    docs = await _cached_query(req.query, req.top_k, store.version)
+    snippets = [doc for doc, _, _ in docs]
     answer = await generate_answer(snippets, req.query)
     
     # Enhanced response with metadata
     results_with_metadata = []
-    for doc, score in docs:
-        chunk_metadata = store.get_chunk_metadata(doc)
+    for doc, score, chunk_metadata in docs:
         results_with_metadata.append({
             "text": doc,
             "score": score,
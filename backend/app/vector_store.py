@@ -1,22 +1,125 @@
 # vector_store.py
+import asyncio
 import numpy as np
-from app.embeddings import embed_text
-from typing import List, Dict, Optional, Any
-from collections import defaultdict
+from functools import partial
+from app.embeddings import embed_text, query_embedder
+from typing import List, Dict, Any
+from collections import Counter, defaultdict
+from itertools import compress
 from app.chunking_service import EnhancedChunk
 
+# Optional SIMD similarity kernels
+try:
+    import simsimd
+    SIMSIMD_AVAILABLE = True
+except ImportError:
+    SIMSIMD_AVAILABLE = False
+    simsimd = None
+
+# Optional approximate nearest-neighbour index for large corpora
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+    faiss = None
+
+# Optional GPU backend for exact search over very large corpora
+try:
+    import torch
+    TORCH_CUDA_AVAILABLE = torch.cuda.is_available()
+except ImportError:
+    TORCH_CUDA_AVAILABLE = False
+    torch = None
+
+RERANK_FACTOR = 10  # int8 shortlist size as a multiple of top_k, rescored in float32
+HNSW_MIN_SIZE = 1_000_000  # Exact scans stay in the tens of milliseconds below this; graph builds take minutes
+HNSW_M = 32  # Graph neighbours per node
+HNSW_EF_SEARCH = 64  # Candidate list size per query; higher trades speed for recall
+HNSW_REBUILD_FRACTION = 0.2  # Rebuild once rows added or deleted since the last build exceed this share of the graph
+GPU_MIN_SIZE = 100_000  # Below this host-device transfer costs more than the CPU scan
+GPU_DEVICE = "cuda"
+
+def _normalize_rows(embs: np.ndarray) -> np.ndarray:
+    """Scale each embedding to unit length in place"""
+    embs /= np.linalg.norm(embs, axis=1, keepdims=True).clip(min=1e-12)
+    return embs
+
+def _quantize_rows(embs: np.ndarray) -> np.ndarray:
+    """Quantize each row to int8 with its own scale; cosine similarity is scale-invariant"""
+    scales = 127.0 / np.abs(embs).max(axis=1, keepdims=True).clip(min=1e-12)
+    return np.round(embs * scales).astype(np.int8)
+
+def _grow(buffer: np.ndarray | None, size: int, capacity: int, row_shape: tuple, dtype) -> np.ndarray:
+    """Allocate a larger row buffer and copy over the first size rows"""
+    grown = np.empty((capacity, *row_shape), dtype=dtype)
+    if buffer is not None:
+        grown[:size] = buffer[:size]
+    return grown
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k highest scores, best first: O(N) selection, then a sort of only those k"""
+    top = np.argpartition(-scores, k - 1)[:k] if scores.shape[0] > k else np.arange(scores.shape[0])
+    return top[np.argsort(-scores[top])]
+
+class _HNSWGraph:
+    """FAISS HNSW graph over a snapshot of rows, labelled by stable row id; deletes are filtered, not removed"""
+
+    def __init__(self, embeddings: np.ndarray, row_ids: np.ndarray, upto: int):
+        # Runs in a worker thread: building the graph takes seconds to minutes
+        self.index = faiss.IndexIDMap(faiss.IndexHNSWFlat(embeddings.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT))
+        self.index.add_with_ids(embeddings, row_ids)
+        self.size = row_ids.shape[0]
+        self.upto = upto  # Every row id below this was live when the snapshot was taken
+        self.deleted = np.empty(0, dtype=np.int64)
+        self._set_params()
+
+    def mark_deleted(self, row_ids: np.ndarray) -> None:
+        """Exclude deleted rows from future searches; HNSW graphs cannot drop nodes"""
+        row_ids = row_ids[row_ids < self.upto]
+        if row_ids.size:
+            self.deleted = np.concatenate((self.deleted, row_ids))
+            self._set_params()
+
+    def search(self, emb: np.ndarray, k: int):
+        """Return (row ids, scores) of the k nearest live rows in the graph"""
+        scores, labels = self.index.search(emb[None, :], k, params=self.params)
+        found = labels[0] >= 0  # FAISS pads with -1 when it finds fewer than k neighbours
+        return labels[0][found], scores[0][found]
+
+    def _set_params(self) -> None:
+        # Keep the selectors referenced: the parameters object only holds raw pointers to them
+        if self.deleted.size:
+            self._deleted_selector = faiss.IDSelectorBatch(self.deleted)
+            self._live_selector = faiss.IDSelectorNot(self._deleted_selector)
+            self.params = faiss.SearchParametersHNSW(sel=self._live_selector, efSearch=HNSW_EF_SEARCH)
+        else:
+            self.params = faiss.SearchParametersHNSW(efSearch=HNSW_EF_SEARCH)
+
 class InMemoryStore:
     def __init__(self):
         self.docs: List[str] = []
+        # Preallocated row buffers; only the first _size rows are live
         self.embeddings: np.ndarray | None = None
+        self.q_embeddings: np.ndarray | None = None  # int8 copy of embeddings, scanned by SimSIMD
+        self._row_ids: np.ndarray | None = None  # Stable, ascending id per row; HNSW labels refer to these
+        self._next_row_id = 0
+        self._size = 0
+        self._capacity = 0
+        self._hnsw: _HNSWGraph | None = None  # Queried once a background build has finished
+        self._hnsw_build: asyncio.Future | None = None
+        self._gpu_embeddings = None  # float16 copy of the live rows in GPU memory, built on first large query
         self.chunk_metadata: List[Dict[str, Any]] = []  # Metadata for each chunk
         self.documents: Dict[str, Dict[str, Any]] = {}  # Document-level metadata
         self.doc_to_chunks: Dict[str, List[int]] = defaultdict(list)  # Map doc_id to chunk indices
+        self.type_counts: Counter = Counter()  # Documents per file type, kept in step with documents
+        self.version = 0  # Bumped on every ingest or delete so cached query results can be keyed on it
 
     async def ingest(self, texts: List[str]) -> int:
         """Legacy method for backward compatibility"""
-        resp_data = await embed_text(texts)
-        embs = np.array([item["embedding"] for item in resp_data])
+        if not texts:
+            return 0  # e.g. an image-only PDF; an empty embedding batch has no row shape to store
+        embs = _normalize_rows(np.ascontiguousarray(await embed_text(texts), dtype=np.float32))
         self.docs.extend(texts)
         
         # Add empty metadata for legacy chunks
@@ -27,16 +130,15 @@ class InMemoryStore:
                 "chunk_id": f"legacy_{len(self.chunk_metadata)}"
             })
         
-        if self.embeddings is None:
-            self.embeddings = embs
-        else:
-            self.embeddings = np.vstack((self.embeddings, embs))
+        self._append_embeddings(embs)
+        self.version += 1
         return len(texts)
 
     async def ingest_with_metadata(self, texts: List[str], enhanced_chunks: List[EnhancedChunk]) -> int:
         """Enhanced ingestion with metadata support"""
-        resp_data = await embed_text(texts)
-        embs = np.array([item["embedding"] for item in resp_data])
+        if not texts:
+            return 0  # e.g. an image-only PDF; an empty embedding batch has no row shape to store
+        embs = _normalize_rows(np.ascontiguousarray(await embed_text(texts), dtype=np.float32))
         
         start_index = len(self.docs)
         self.docs.extend(texts)
@@ -49,47 +151,149 @@ class InMemoryStore:
             
             # Store document-level metadata (only once per document)
             if chunk.parent_doc_id not in self.documents:
+                doc = chunk.doc
                 self.documents[chunk.parent_doc_id] = {
                     "doc_id": chunk.parent_doc_id,
-                    "filename": chunk.metadata.get("source_file", ""),
-                    "file_type": chunk.metadata.get("file_type", ""),
-                    "title": chunk.metadata.get("doc_title", ""),
-                    "author": chunk.metadata.get("doc_author", ""),
-                    "created_date": chunk.metadata.get("doc_created_date"),
-                    "file_size": chunk.metadata.get("doc_file_size", 0),
-                    "total_pages": chunk.metadata.get("total_pages", 0),
-                    "total_chunks": 0  # Will be updated below
+                    "filename": doc.filename,
+                    "file_type": doc.file_type,
+                    "title": doc.title,
+                    "author": doc.author,
+                    "created_date": doc.created_date.isoformat() if doc.created_date else None,
+                    "file_size": doc.file_size,
+                    "total_pages": doc.pages,
+                    "total_chunks": 0
                 }
+                self.type_counts[doc.file_type] += 1
+            # Count chunks as they are mapped instead of re-scanning the batch afterwards
+            self.documents[chunk.parent_doc_id]["total_chunks"] += 1
         
-        # Update chunk counts for documents
-        for doc_id in set(chunk.parent_doc_id for chunk in enhanced_chunks):
-            self.documents[doc_id]["total_chunks"] = len(self.doc_to_chunks[doc_id])
-        
-        if self.embeddings is None:
-            self.embeddings = embs
-        else:
-            self.embeddings = np.vstack((self.embeddings, embs))
+        self._append_embeddings(embs)
+        self.version += 1
         
         return len(texts)
 
+    def _append_embeddings(self, embs: np.ndarray) -> None:
+        """Append normalized float32 rows, keeping the int8 copy in step"""
+        # Enforce the float32 C-order layout the scan kernels expect; free for the arrays both ingest paths build
+        embs = np.ascontiguousarray(embs, dtype=np.float32)
+        n, dim = embs.shape
+        if self._size + n > self._capacity:
+            # Grow geometrically so repeated uploads copy the corpus O(log N) times, not once per upload
+            capacity = max(2 * self._capacity, self._size + n)
+            self.embeddings = _grow(self.embeddings, self._size, capacity, (dim,), np.float32)
+            if SIMSIMD_AVAILABLE:
+                self.q_embeddings = _grow(self.q_embeddings, self._size, capacity, (dim,), np.int8)
+            self._row_ids = _grow(self._row_ids, self._size, capacity, (), np.int64)
+            self._capacity = capacity
+        self.embeddings[self._size:self._size + n] = embs
+        if SIMSIMD_AVAILABLE:
+            self.q_embeddings[self._size:self._size + n] = _quantize_rows(embs)
+        self._row_ids[self._size:self._size + n] = np.arange(self._next_row_id, self._next_row_id + n)
+        self._next_row_id += n
+        if self._gpu_embeddings is not None:
+            self._gpu_embeddings = torch.cat((self._gpu_embeddings, self._to_gpu(embs)))
+        self._size += n
+        # New rows are scanned exactly until a rebuild folds them into the graph
+        self._schedule_hnsw_build()
+
     async def query(self, text: str, top_k: int = 3):
-        """Query with similarity search"""
-        if self.embeddings is None or len(self.docs) == 0:
+        """Query with similarity search, returning (text, score, chunk metadata) tuples"""
+        if self._size == 0:
             return []
             
-        resp_data = await embed_text([text])
-        emb = np.array(resp_data[0]["embedding"])
-        sims = (self.embeddings @ emb) / (np.linalg.norm(self.embeddings, axis=1) * np.linalg.norm(emb))
-        top_ids = np.argsort(-sims)[:top_k]
-        return [(self.docs[i], float(sims[i])) for i in top_ids]
-
-    def get_chunk_metadata(self, chunk_text: str) -> Optional[Dict[str, Any]]:
-        """Get metadata for a specific chunk"""
-        try:
-            chunk_index = self.docs.index(chunk_text)
-            return self.chunk_metadata[chunk_index]
-        except (ValueError, IndexError):
-            return None
+        emb = np.asarray(await query_embedder.embed(text), dtype=np.float32)
+        # Stored rows are unit-length, so cosine similarity is a single dot product per row
+        emb = emb / max(np.linalg.norm(emb), 1e-12)
+        k = min(top_k, self._size)
+        if k <= 0:
+            return []
+        
+        if TORCH_CUDA_AVAILABLE and self._size >= GPU_MIN_SIZE:
+            top_ids, scores = self._search_gpu(emb, k)
+        elif self._hnsw is not None:
+            top_ids, scores = self._search_hnsw(emb, k)
+        else:
+            sims = self._cosine_similarities(emb, top_k)
+            top_ids = _top_k(sims, k)
+            scores = sims[top_ids]
+        # Resolve metadata now: row indices shift if a document is deleted while the caller awaits
+        return [(self.docs[i], float(score), self.chunk_metadata[i]) for i, score in zip(top_ids, scores)]
+
+    def _to_gpu(self, embs: np.ndarray):
+        return torch.from_numpy(embs).to(GPU_DEVICE, torch.float16)
+
+    def _search_gpu(self, emb: np.ndarray, k: int):
+        """Exact top-k as one matrix-vector product against the float16 rows on the GPU"""
+        if self._gpu_embeddings is None:
+            self._gpu_embeddings = self._to_gpu(self.embeddings[:self._size])
+        scores, ids = torch.topk(self._gpu_embeddings @ self._to_gpu(emb), k)
+        return ids.cpu().numpy(), scores.float().cpu().numpy()
+
+    def _search_hnsw(self, emb: np.ndarray, k: int):
+        """Top-k from the HNSW graph, merged with an exact scan of rows appended since it was built"""
+        graph = self._hnsw
+        row_ids = self._row_ids[:self._size]
+        graph_ids, graph_scores = graph.search(emb, k)
+        # Row ids ascend with buffer position, so a binary search maps graph labels back to rows
+        tail_start = int(np.searchsorted(row_ids, graph.upto))
+        rows = np.concatenate((np.searchsorted(row_ids, graph_ids), np.arange(tail_start, self._size)))
+        scores = np.concatenate((graph_scores, self.embeddings[tail_start:self._size] @ emb))
+        top = _top_k(scores, k)
+        return rows[top], scores[top]
+
+    def _schedule_hnsw_build(self) -> None:
+        """Build the HNSW graph in a worker thread once the corpus is large enough or the graph is stale"""
+        if self._size < HNSW_MIN_SIZE:
+            self._hnsw = None  # Small enough for the exact scan again
+            return
+        if not FAISS_AVAILABLE or self._hnsw_build is not None:
+            return
+        graph = self._hnsw
+        if graph is not None:
+            appended = self._size - int(np.searchsorted(self._row_ids[:self._size], graph.upto))
+            if appended + graph.deleted.size <= HNSW_REBUILD_FRACTION * graph.size:
+                return
+        
+        # delete_document compacts into fresh buffers while a build is reading this one
+        row_ids = self._row_ids[:self._size].copy()
+        self._hnsw_build = asyncio.get_running_loop().run_in_executor(
+            None, _HNSWGraph, self.embeddings[:self._size], row_ids, self._next_row_id
+        )
+        self._hnsw_build.add_done_callback(partial(self._install_hnsw, row_ids))
+
+    def _install_hnsw(self, row_ids: np.ndarray, build: asyncio.Future) -> None:
+        """Swap in a finished graph; until then queries keep using the previous graph or the exact scan"""
+        self._hnsw_build = None
+        if build.cancelled():
+            return
+        if build.exception() is not None:
+            print(f"HNSW index build failed: {build.exception()}")
+            return
+        if self._size < HNSW_MIN_SIZE:
+            return
+        graph = build.result()
+        # Rows deleted while the graph was being built are filtered like any later delete
+        graph.mark_deleted(np.setdiff1d(row_ids, self._row_ids[:self._size], assume_unique=True))
+        self._hnsw = graph
+        self._schedule_hnsw_build()
+
+    def _cosine_similarities(self, emb: np.ndarray, top_k: int) -> np.ndarray:
+        """Similarity of unit-length emb against stored embeddings; rows outside the shortlist score -inf"""
+        embeddings = self.embeddings[:self._size]
+        if not SIMSIMD_AVAILABLE:
+            return embeddings @ emb
+        
+        shortlist = top_k * RERANK_FACTOR
+        if self._size <= shortlist:
+            return np.asarray(simsimd.cdist(emb[None, :], embeddings, metric="dot")).ravel()
+        
+        # Scan the 4x smaller int8 copy, then rescore only the shortlist exactly in float32
+        q_embeddings = self.q_embeddings[:self._size]
+        dists = np.asarray(simsimd.cdist(_quantize_rows(emb[None, :]), q_embeddings, metric="cosine")).ravel()
+        candidates = np.argpartition(dists, shortlist)[:shortlist]
+        sims = np.full(self._size, -np.inf, dtype=np.float32)
+        sims[candidates] = embeddings[candidates] @ emb
+        return sims
 
     async def get_documents_list(self) -> List[Dict[str, Any]]:
         """Get list of all documents with their metadata"""
@@ -100,31 +304,41 @@ class InMemoryStore:
         if doc_id not in self.doc_to_chunks:
             return 0
         
-        chunk_indices = self.doc_to_chunks[doc_id]
-        chunk_indices.sort(reverse=True)  # Delete from end to avoid index shifting
+        chunk_indices = self.doc_to_chunks.pop(doc_id)
+        file_type = self.documents.pop(doc_id)["file_type"]
+        self.type_counts[file_type] -= 1
+        if not self.type_counts[file_type]:
+            del self.type_counts[file_type]
         
-        deleted_count = 0
-        for idx in chunk_indices:
-            if idx < len(self.docs):
-                # Remove from all arrays
-                del self.docs[idx]
-                del self.chunk_metadata[idx]
-                if self.embeddings is not None:
-                    self.embeddings = np.delete(self.embeddings, idx, axis=0)
-                deleted_count += 1
+        # Drop every chunk of the document in one pass instead of one reallocation per chunk
+        keep = np.ones(self._size, dtype=bool)
+        keep[chunk_indices] = False
+        self.docs = list(compress(self.docs, keep))
+        self.chunk_metadata = list(compress(self.chunk_metadata, keep))
         
-        # Update mappings after deletion
-        del self.doc_to_chunks[doc_id]
-        del self.documents[doc_id]
+        # Compact the live rows in place so the buffers keep their capacity
+        remaining = len(self.docs)
+        deleted_row_ids = self._row_ids[:self._size][~keep]
+        # A background graph build may still be reading the float32 rows, so compact into a new buffer then
+        embeddings = self.embeddings if self._hnsw_build is None else np.empty_like(self.embeddings)
+        embeddings[:remaining] = self.embeddings[:self._size][keep]
+        self.embeddings = embeddings
+        if self.q_embeddings is not None:
+            self.q_embeddings[:remaining] = self.q_embeddings[:self._size][keep]
+        self._row_ids[:remaining] = self._row_ids[:self._size][keep]
+        deleted_count = self._size - remaining
+        self._size = remaining
+        # The graph keeps serving with deleted rows filtered out; a rebuild starts once enough have gone
+        if self._hnsw is not None:
+            self._hnsw.mark_deleted(deleted_row_ids)
+        self._schedule_hnsw_build()
+        self._gpu_embeddings = None
+        self.version += 1
         
-        # Update chunk indices in remaining documents
+        # Renumber remaining chunk indices: a kept row's new index is the count of kept rows before it
+        new_index = np.cumsum(keep) - 1
         for remaining_doc_id, remaining_indices in self.doc_to_chunks.items():
-            updated_indices = []
-            for idx in remaining_indices:
-                # Count how many indices were deleted before this one
-                deleted_before = sum(1 for del_idx in chunk_indices if del_idx < idx)
-                updated_indices.append(idx - deleted_before)
-            self.doc_to_chunks[remaining_doc_id] = updated_indices
+            self.doc_to_chunks[remaining_doc_id] = new_index[remaining_indices].tolist()
         
         return deleted_count
 
@@ -133,14 +347,10 @@ class InMemoryStore:
         return {
             "total_documents": len(self.documents),
             "total_chunks": len(self.docs),
-            "total_embeddings": self.embeddings.shape[0] if self.embeddings is not None else 0,
+            "total_embeddings": self._size,
             "documents_by_type": self._get_documents_by_type()
         }
 
     def _get_documents_by_type(self) -> Dict[str, int]:
         """Count documents by file type"""
-        type_counts = defaultdict(int)
-        for doc_meta in self.documents.values():
-            file_type = doc_meta.get("file_type", "unknown")
-            type_counts[file_type] += 1
-        return dict(type_counts)
+        return dict(self.type_counts)